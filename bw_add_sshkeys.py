@@ -3,96 +3,507 @@
 Extracts SSH keys from Bitwarden vault
 """
 
+import os
+import sys
+
+# Resolved once, as realpath() stats every path component
+SELF_PATH = os.path.realpath(__file__)
+
+# ssh-add runs this script as SSH_ASKPASS once per encrypted key, so answer
+# with the passphrase before paying for any other import
+if __name__ == "__main__" and os.environ.get("SSH_ASKPASS") == SELF_PATH:
+    # ssh-add asks again with "Bad passphrase, try again..." when the stored one
+    # is wrong, so fail to make it give up on the key instead of looping forever
+    if len(sys.argv) > 1 and sys.argv[1].startswith("Bad passphrase"):
+        sys.exit(1)
+    print(os.environ.get("SSH_KEY_PASSPHRASE", ""))
+    sys.exit(0)
+
 import argparse
+import functools
+import itertools
 import json
 import logging
-import os
+import shutil
+import socket
 import subprocess
-from typing import Any
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from types import TracebackType
+from typing import IO, Any, Iterable, Iterator, Optional, cast
+
+try:
+    # Optional: stream-decode vault listings instead of loading them whole,
+    # only worth it with the C backend as the pure Python one is much slower
+    import ijson
+
+    HAS_IJSON = ijson.backend == "yajl2_c"
+except ImportError:
+    HAS_IJSON = False
+
+try:
+    # Optional: faster JSON decoding
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    # Optional: cache the Bitwarden session in the OS keyring between runs
+    import keyring
+    import keyring.errors
+
+    HAS_KEYRING = True
+except ImportError:
+    HAS_KEYRING = False
 
+# Upper bound on the number of vault items processed concurrently
+MAX_WORKERS = 8
 
-def get_session(session: str) -> str:
+# Address and startup timeout (in seconds) of the local `bw serve` API
+SERVE_HOST = "127.0.0.1"
+SERVE_TIMEOUT = 30
+
+# Keyring service and user name under which the Bitwarden session is cached
+KEYRING_SERVICE = "bw_add_sshkeys"
+KEYRING_USERNAME = "session"
+
+log = logging.getLogger(__name__)
+
+# Environment for ssh-add when there's no passphrase to hand over, shared by
+# every call as subprocess never modifies it
+NOPASS_ENV = dict(os.environ, SSH_ASKPASS_REQUIRE="never")
+
+
+@functools.lru_cache(maxsize=None)
+def which(command: str) -> str:
     """
-    Function to return a valid Bitwarden session
+    Function to return the absolute path of a command
+
+    subprocess only spawns children with posix_spawn (instead of fork + exec)
+    when given an absolute path and close_fds=False, which is safe as Python
+    file descriptors are not inheritable by default.
+    """
+    return shutil.which(command) or command
+
+
+def get_session(session: str, cache: bool = False) -> str:
+    """
+    Function to return a valid Bitwarden session, optionally cached in the
+    keyring between runs
     """
     # Check for an existing, user-supplied Bitwarden session
     if not session:
         session = os.environ.get("BW_SESSION", "")
     if session:
-        logging.debug("Existing Bitwarden session found")
+        log.debug("Existing Bitwarden session found")
         return session
 
-    # Check if we're already logged in
-    proc_logged = subprocess.run(["bw", "login", "--check", "--quiet"], check=False)
+    # Check for a session cached by a previous run that is still valid
+    if cache:
+        session = get_cached_session()
+        if session:
+            log.debug("Cached Bitwarden session found")
+            return session
 
-    if proc_logged.returncode:
-        logging.debug("Not logged into Bitwarden")
+    # Check if we're already logged in
+    if not is_logged_in():
+        log.debug("Not logged into Bitwarden")
         operation = "login"
     else:
-        logging.debug("Bitwarden vault is locked")
+        log.debug("Bitwarden vault is locked")
         operation = "unlock"
 
     proc_session = subprocess.run(
-        ["bw", "--raw", operation],
+        [which("bw"), "--raw", operation],
         stdout=subprocess.PIPE,
         universal_newlines=True,
+        close_fds=False,
         check=True,
     )
     session = proc_session.stdout
-    logging.info(
+    log.info(
         'To re-use this BitWarden session run: export BW_SESSION="%s"',
         session,
     )
+    if cache:
+        set_cached_session(session)
     return session
 
 
-def get_folders(session: str, foldername: str) -> str:
+def bw_data_file() -> str:
     """
-    Function to return the ID  of the folder that matches the provided name
+    Function to return the path of the Bitwarden CLI state file
     """
-    logging.debug("Folder name: %s", foldername)
+    if os.environ.get("BITWARDENCLI_APPDATA_DIR"):
+        appdata = os.path.abspath(os.environ["BITWARDENCLI_APPDATA_DIR"])
+    elif sys.platform == "darwin":
+        appdata = os.path.expanduser("~/Library/Application Support/Bitwarden CLI")
+    elif sys.platform == "win32":
+        appdata = os.path.join(os.environ.get("APPDATA", ""), "Bitwarden CLI")
+    elif os.environ.get("XDG_CONFIG_HOME"):
+        appdata = os.path.join(os.environ["XDG_CONFIG_HOME"], "Bitwarden CLI")
+    else:
+        appdata = os.path.expanduser("~/.config/Bitwarden CLI")
 
-    proc_folders = subprocess.run(
-        ["bw", "list", "folders", "--search", foldername, "--session", session],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-        encoding="utf-8",
+    return os.path.join(appdata, "data.json")
+
+
+def is_logged_in() -> bool:
+    """
+    Function to check if there's an account logged into Bitwarden
+    """
+    # Read the active account from the CLI state instead of starting `bw`
+    try:
+        with open(bw_data_file(), "rb") as data_file:
+            data = json_loads(data_file.read())
+    except (OSError, ValueError) as error:
+        log.debug("Could not read the Bitwarden CLI state: %s", error)
+        data = {}
+
+    # Older CLI versions use "activeUserId"
+    for key in ("global_account_activeAccountId", "activeUserId"):
+        if isinstance(data, dict) and key in data:
+            return bool(data[key])
+
+    proc_logged = subprocess.run(
+        [which("bw"), "login", "--check", "--quiet"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=False,
+        check=False,
     )
+    return not proc_logged.returncode
 
-    folders = json.loads(proc_folders.stdout)
+
+def get_cached_session() -> str:
+    """
+    Function to return the session cached in the keyring, if it's still valid
+    """
+    if not HAS_KEYRING:
+        return ""
 
     try:
-        folder = str([k["id"] for k in folders if k["name"] == foldername][0])
-    except IndexError:
-        logging.debug('"%s" folder not found - falling back to root folder', foldername)
-        folder = "null"
+        session: Optional[str] = keyring.get_password(KEYRING_SERVICE, KEYRING_USERNAME)
+    except keyring.errors.KeyringError as error:
+        log.debug("Could not read the keyring: %s", error)
+        return ""
+    if not session:
+        return ""
+
+    # Cheap query that fails if the vault was locked or logged out since
+    proc_probe = subprocess.run(
+        [
+            which("bw"),
+            "list",
+            "folders",
+            "--search",
+            "__probe__",
+            "--nointeraction",
+            "--session",
+            session,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=False,
+        check=False,
+    )
+    if proc_probe.returncode:
+        log.debug("Cached Bitwarden session is no longer valid")
+        clear_cached_session()
+        return ""
 
-    return folder
+    return session
 
 
-def folder_items(session: str, folder_id: str) -> list[dict[str, Any]]:
+def set_cached_session(session: str) -> None:
     """
-    Function to return items from a folder
+    Function to cache the session in the keyring for the next runs
     """
-    logging.debug("Folder ID: %s", folder_id)
+    if not HAS_KEYRING:
+        return
 
-    proc_items = subprocess.run(
-        ["bw", "list", "items", "--folderid", folder_id, "--session", session],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-        encoding="utf-8",
-    )
+    try:
+        keyring.set_password(KEYRING_SERVICE, KEYRING_USERNAME, session)
+    except keyring.errors.KeyringError as error:
+        log.debug("Could not write to the keyring: %s", error)
+
+
+def clear_cached_session() -> bool:
+    """
+    Function to remove the session cached in the keyring, returning whether
+    there was one
+    """
+    if not HAS_KEYRING:
+        return False
+
+    try:
+        keyring.delete_password(KEYRING_SERVICE, KEYRING_USERNAME)
+    except keyring.errors.PasswordDeleteError:
+        log.debug("No cached Bitwarden session to remove")
+        return False
+    except keyring.errors.KeyringError as error:
+        log.debug("Could not write to the keyring: %s", error)
+        return False
+    return True
+
+
+def json_loads(data: bytes) -> Any:
+    """
+    Decodes a JSON document, using orjson if it is installed
+    """
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
 
-    data: list[dict[str, Any]] = json.loads(proc_items.stdout)
 
-    return data
+def iter_objects(stream: IO[bytes], prefix: str) -> Iterator[dict[str, Any]]:
+    """
+    Yields the objects of the JSON list at prefix (dot separated) as they are
+    decoded
+    """
+    if HAS_IJSON:
+        yield from ijson.items(stream, prefix + ".item" if prefix else "item")
+        return
+
+    data = json_loads(stream.read())
+    for key in prefix.split(".") if prefix else []:
+        data = data[key]
+    yield from data
+
+
+class BwCli:
+    """
+    Queries the vault by running a `bw` process for every call
+    """
+
+    def __init__(self, session: str) -> None:
+        self.session = session
+
+    def __enter__(self) -> "BwCli":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        pass
+
+    def list_objects(self, kind: str, **options: str) -> Iterator[dict[str, Any]]:
+        """
+        Starts `bw list` right away and returns an iterator over the objects it
+        lists, decoded as they are read
+        """
+        command = [which("bw"), "list", kind]
+        for option, value in options.items():
+            command += ["--" + option, value]
+        command += ["--session", self.session]
+
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=False)
+        return self._read_objects(proc, command)
+
+    @staticmethod
+    def _read_objects(
+        proc: "subprocess.Popen[bytes]", command: list[str]
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Yields the objects printed by a `bw list` process
+        """
+        with proc:
+            try:
+                yield from iter_objects(cast(IO[bytes], proc.stdout), "")
+            except Exception:
+                # A failing `bw` leaves stdout empty, so report its exit status
+                if proc.wait():
+                    raise subprocess.CalledProcessError(
+                        proc.returncode, command
+                    ) from None
+                raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, command)
+
+    def get_attachment(self, item_id: str, attachment_id: str) -> bytes:
+        """
+        Returns the contents of an attachment
+        """
+        try:
+            proc_attachment = subprocess.run(
+                [
+                    which("bw"),
+                    "get",
+                    "attachment",
+                    attachment_id,
+                    "--itemid",
+                    item_id,
+                    "--raw",
+                    "--session",
+                    self.session,
+                ],
+                stdout=subprocess.PIPE,
+                close_fds=False,
+                check=True,
+            )
+        except subprocess.CalledProcessError:
+            raise RuntimeError("Could not get attachment from Bitwarden")
+
+        return proc_attachment.stdout
+
+
+class BwServe(BwCli):
+    """
+    Runs `bw serve` for the lifetime of the context, so that the vault is only
+    loaded once and every query is a local HTTP request instead of a new `bw`
+    process
+
+    CAVEAT: while it runs, the unlocked vault API is reachable without any
+    authentication by every local user and process through SERVE_HOST
+    """
+
+    def __init__(self, session: str) -> None:
+        super().__init__(session)
+        self.port = 0
+        self.proc: Optional[subprocess.Popen[bytes]] = None
+
+    def __enter__(self) -> "BwServe":
+        # Let the OS pick a free ephemeral port. CAVEAT: it's released before
+        # bw serve binds it, so another local process could take it meanwhile
+        with socket.socket() as sock:
+            sock.bind((SERVE_HOST, 0))
+            self.port = sock.getsockname()[1]
+
+        log.info("Starting Bitwarden API server")
+        log.debug("Starting bw serve on port %d", self.port)
+        self.proc = subprocess.Popen(
+            [
+                which("bw"),
+                "serve",
+                "--hostname",
+                SERVE_HOST,
+                "--port",
+                str(self.port),
+                "--session",
+                self.session,
+            ],
+            stdout=subprocess.DEVNULL,
+            close_fds=False,
+        )
+
+        try:
+            self._wait_until_listening()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+
+        return self
+
+    def _wait_until_listening(self) -> None:
+        assert self.proc is not None
+        deadline = time.monotonic() + SERVE_TIMEOUT
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError("bw serve exited unexpectedly")
+            try:
+                with socket.create_connection((SERVE_HOST, self.port), timeout=1):
+                    return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Timed out waiting for bw serve to start")
+                time.sleep(0.1)
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        if self.proc is None:
+            return
+        log.debug("Stopping bw serve")
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def request(self, path: str) -> IO[bytes]:
+        """
+        Returns the response of a GET request against the local API
+        """
+        url = "http://%s:%d%s" % (SERVE_HOST, self.port, path)
+        try:
+            response: IO[bytes] = urllib.request.urlopen(url, timeout=SERVE_TIMEOUT)
+        except OSError as error:
+            raise RuntimeError("Could not query Bitwarden (%s): %s" % (path, error))
+        return response
+
+    def get(self, path: str) -> bytes:
+        """
+        Returns the raw body of a GET request against the local API
+        """
+        with self.request(path) as response:
+            return response.read()
+
+    def list_objects(self, kind: str, **options: str) -> Iterator[dict[str, Any]]:
+        """
+        Sends a `/list/object/...` request right away and returns an iterator
+        over the objects of its response, decoded as they are read
+        """
+        path = "/list/object/%s?%s" % (kind, urllib.parse.urlencode(options))
+        return self._read_response(self.request(path))
+
+    @staticmethod
+    def _read_response(response: IO[bytes]) -> Iterator[dict[str, Any]]:
+        """
+        Yields the objects of a `/list/object/...` response
+        """
+        with response:
+            yield from iter_objects(response, "data.data")
+
+    def get_attachment(self, item_id: str, attachment_id: str) -> bytes:
+        """
+        Returns the contents of an attachment
+        """
+        return self.get(
+            "/object/attachment/%s?%s"
+            % (
+                urllib.parse.quote(attachment_id),
+                urllib.parse.urlencode({"itemid": item_id}),
+            )
+        )
+
+
+def folder_items(vault: BwCli, foldername: str) -> Iterator[dict[str, Any]]:
+    """
+    Function to return items from the folder that matches the provided name
+    """
+    log.debug("Folder name: %s", foldername)
+
+    # Both listings are started before either is read, so the two `bw`
+    # processes start up and decrypt the vault at the same time. The items
+    # can't be filtered by a folder ID that isn't known yet, so list them all
+    # and keep those of the folder here
+    items = vault.list_objects("items")
+    folders = vault.list_objects("folders", search=foldername)
+
+    folder_id = next((str(k["id"]) for k in folders if k["name"] == foldername), None)
+    if folder_id is None:
+        log.debug('"%s" folder not found - falling back to root folder', foldername)
+
+    log.debug("Folder ID: %s", folder_id)
+
+    return (item for item in items if item.get("folderId") == folder_id)
 
 
 def add_ssh_keys(
-    session: str,
-    items: list[dict[str, Any]],
+    vault: BwCli,
+    items: Iterable[dict[str, Any]],
     keyname: str,
     pwkeyname: str,
     pwkey: str,
@@ -100,151 +511,253 @@ def add_ssh_keys(
     quiet: bool,
 ) -> None:
     """
-    Function to attempt to get keys from a vault item
+    Function to attempt to get keys from the vault items
     """
-    for item in items:
-        logging.info("----------------------------------")
-        logging.info('Processing item "%s"', item["name"])
-        try:
-            ssh_key = fetch_key(session, item, keyname, legacymode)
-        except RuntimeError as error:
-            logging.error(str(error))
-            continue
+    # Attachment downloads of different items can overlap, and items are picked
+    # up as soon as they are decoded
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(
+            lambda item: _process_item(
+                vault, item, keyname, pwkeyname, pwkey, legacymode
+            ),
+            items,
+        )
+        keys = (result for result in results if result is not None)
 
-        private_key_pw = pwkey
+        # The agent offers keys in the order they were added, so add them one
+        # ssh-add at a time in vault order. Consecutive keys sharing a
+        # passphrase can still be added by a single ssh-add process
+        for key_pw, group in itertools.groupby(keys, key=lambda result: result[2]):
+            _add_bucket([(name, ssh_key) for name, ssh_key, _ in group], key_pw, quiet)
 
-        if "fields" in item:
-            try:
-                private_key_pw = [
-                    k["value"] for k in item["fields"] if k["name"] == pwkeyname
-                ][0]
-                logging.debug("Passphrase declared")
-            except IndexError:
-                logging.warning(
-                    'No "%s" field found for item %s', pwkeyname, item["name"]
-                )
 
-        try:
-            ssh_add(ssh_key, private_key_pw, quiet)
-        except subprocess.SubprocessError:
-            logging.warning('Could not add key "%s" to the SSH agent', item["name"])
+def _process_item(
+    vault: BwCli,
+    item: dict[str, Any],
+    keyname: str,
+    pwkeyname: str,
+    pwkey: str,
+    legacymode: bool,
+) -> Optional[tuple[str, bytes, str]]:
+    """
+    Function to attempt to get a key from a vault item, returning the item
+    name, the key and its passphrase
+    """
+    log.info('Processing item "%s"', item["name"])
+
+    # Index custom fields and attachments by name once, keeping the first of
+    # any duplicate names
+    fields: dict[str, Any] = {}
+    for field in item.get("fields") or []:
+        fields.setdefault(field["name"], field["value"])
+    attachments: dict[str, str] = {}
+    for attachment in item.get("attachments") or []:
+        attachments.setdefault(attachment["fileName"], attachment["id"])
+
+    try:
+        ssh_key = fetch_key(vault, item, fields, attachments, keyname, legacymode)
+    except RuntimeError as error:
+        log.error(str(error))
+        return None
+
+    private_key_pw = fields.get(pwkeyname, pwkey)
+
+    if pwkeyname in fields:
+        log.debug("Passphrase declared")
+    elif "fields" in item:
+        log.warning('No "%s" field found for item %s', pwkeyname, item["name"])
 
+    return item["name"], ssh_key, private_key_pw or ""
 
-def fetch_key(session: str, item: dict[str, Any], keyname: str, legacymode: bool) -> str:
+
+def _add_bucket(bucket: list[tuple[str, bytes]], key_pw: str, quiet: bool) -> None:
+    """
+    Function to add the keys of a list of (item name, key) sharing a passphrase
+    """
+    try:
+        ssh_add([ssh_key for _, ssh_key in bucket], key_pw, quiet)
+    except subprocess.SubprocessError:
+        log.warning(
+            "Could not add some of the keys %s to the SSH agent",
+            ", ".join('"%s"' % name for name, _ in bucket),
+        )
+        return
+
+    for name, _ in bucket:
+        log.info('Added key "%s" to the SSH agent', name)
+
+
+def fetch_key(
+    vault: BwCli,
+    item: dict[str, Any],
+    fields: dict[str, Any],
+    attachments: dict[str, str],
+    keyname: str,
+    legacymode: bool,
+) -> bytes:
     if "sshKey" in item and item["sshKey"].get("privateKey"):
-        logging.debug("Item %s has an ssh key - using it", item["name"])
-        return item["sshKey"].get("privateKey")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Item %s has an ssh key - using it", item["name"])
+        private_key: str = item["sshKey"]["privateKey"]
+        return private_key.encode("utf-8")
 
     if not legacymode:
         raise RuntimeError("Item %s does not have an ssh key" % item["name"])
 
-    logging.debug("Couldn't find an ssh key - falling back to attachments")
+    log.debug("Couldn't find an ssh key - falling back to attachments")
 
-    if "attachments" in item:
-        logging.debug(
-            "Item %s has attachments - searching for %s",
-            item["name"],
-            keyname,
-        )
+    if attachments:
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Item %s has attachments - searching for %s",
+                item["name"],
+                keyname,
+            )
         try:
-            return fetch_from_attachment(session, item, keyname)
+            return fetch_from_attachment(vault, item, fields, attachments, keyname)
         except RuntimeWarning as warning:
-            logging.warning(str(warning))
+            log.warning(str(warning))
         except RuntimeError as error:
-            logging.error(str(error))
+            log.error(str(error))
 
-    logging.debug("Couldn't find an ssh key in attachments - falling back to notes")
+    log.debug("Couldn't find an ssh key in attachments - falling back to notes")
 
     if isinstance(item["notes"], str) and item["notes"].startswith("-----BEGIN"):
-        return item["notes"]
+        notes: str = item["notes"]
+        return notes.encode("utf-8")
 
     raise RuntimeError("Could not find an SSH key on item %s" % item["name"])
 
 
-def fetch_from_attachment(session: str, item: dict[str, Any], keyname: str) -> str:
+def fetch_from_attachment(
+    vault: BwCli,
+    item: dict[str, Any],
+    fields: dict[str, Any],
+    attachments: dict[str, str],
+    keyname: str,
+) -> bytes:
     """
     Function to get the key contents from the Bitwarden vault
     """
-    private_key_file = ""
-    try:
-        private_key_file = [k["value"] for k in item["fields"] if k["name"] == keyname][
-            0
-        ]
-    except Exception:
-        logging.warning(
-            'No "%s" field found for item %s -- falling back to the default "id_" attachment' % (keyname, item["name"])
+    private_key_file = fields.get(keyname, "")
+    if keyname not in fields:
+        log.warning(
+            'No "%s" field found for item %s -- falling back to the default "id_" attachment'
+            % (keyname, item["name"])
         )
 
-    try:
-        private_key_id = [
-            k["id"] for k in item["attachments"] if private_key_file and k["fileName"] == private_key_file or k["fileName"].startswith("id_")
-        ][0]
-    except IndexError:
+    # Prefer the attachment named in the custom field, then any "id_" one
+    if private_key_file and private_key_file in attachments:
+        private_key_id: Optional[str] = attachments[private_key_file]
+    else:
+        private_key_id = next(
+            (
+                attachment_id
+                for filename, attachment_id in attachments.items()
+                if filename.startswith("id_")
+            ),
+            None,
+        )
+    if private_key_id is None:
         raise RuntimeWarning(
             'No attachment called "%s" found for item %s'
             % (private_key_file, item["name"])
         )
 
-    logging.debug("Private key ID found")
-    logging.debug("Item ID: %s", item["id"])
-    logging.debug("Key ID: %s", private_key_id)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Private key ID found")
+        log.debug("Item ID: %s", item["id"])
+        log.debug("Key ID: %s", private_key_id)
 
     try:
-        proc_attachment = subprocess.run(
-            [
-                "bw",
-                "get",
-                "attachment",
-                private_key_id,
-                "--itemid",
-                item["id"],
-                "--raw",
-                "--session",
-                session,
-            ],
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            check=True,
-        )
-    except subprocess.CalledProcessError:
+        return vault.get_attachment(item["id"], private_key_id)
+    except RuntimeError:
         raise RuntimeError("Could not get attachment from Bitwarden")
 
-    return proc_attachment.stdout
-
 
-def ssh_add(ssh_key: str, key_pw: str = "", quiet: bool = False) -> None:
+def ssh_add(ssh_keys: list[bytes], key_pw: str = "", quiet: bool = False) -> None:
     """
-    Adds the key to the agent
+    Adds the keys to the agent with a single ssh-add process
     """
     if key_pw:
+        # Use the stored passphrase even when ssh-add could prompt on a tty
         envdict = dict(
             os.environ,
-            SSH_ASKPASS=os.path.realpath(__file__),
+            SSH_ASKPASS=SELF_PATH,
+            SSH_ASKPASS_REQUIRE="force",
             SSH_KEY_PASSPHRASE=key_pw,
         )
     else:
-        envdict = dict(os.environ, SSH_ASKPASS_REQUIRE="never")
+        envdict = NOPASS_ENV
 
-    logging.debug("Running ssh-add")
+    log.debug("Running ssh-add")
 
-    # if the key doesn't end with a line break, let's add it
-    if not ssh_key.endswith("\n"):
-        logging.debug("Adding a line break at the end of the key")
-        ssh_key += "\n"
-    
-    quietFlag = ""
+    # if a key doesn't end with a line break, let's add it
+    keys = []
+    for ssh_key in ssh_keys:
+        if not ssh_key.endswith(b"\n"):
+            log.debug("Adding a line break at the end of the key")
+            ssh_key += b"\n"
+        keys.append(ssh_key)
+
+    command = [which("ssh-add")]
     if quiet:
-        quietFlag = "-q"
+        command.append("-q")
 
     # CAVEAT: `ssh-add` provides no useful output, even with maximum verbosity
-    subprocess.run(
-        ["ssh-add", quietFlag, "-"],
-        input=ssh_key.encode("utf-8"),
-        # Works even if ssh-askpass is not installed
-        env=envdict,
-        universal_newlines=False,
-        check=True,
-    )
+    if len(keys) == 1 or sys.platform == "win32":
+        # Windows has no /dev/fd, so fall back to one process per key there
+        failed = None
+        for ssh_key in keys:
+            try:
+                subprocess.run(
+                    command + ["-"],
+                    input=ssh_key,
+                    # Works even if ssh-askpass is not installed
+                    env=envdict,
+                    universal_newlines=False,
+                    close_fds=False,
+                    check=True,
+                )
+            except subprocess.CalledProcessError as error:
+                failed = error
+        if failed is not None:
+            raise failed
+        return
+
+    # `ssh-add -` only reads one key from stdin, so hand each key over its own
+    # pipe instead and let ssh-add read them as /dev/fd/N files. Its
+    # "Identity added: /dev/fd/N" output is meaningless, so silence it and let
+    # the caller report the item names
+    if not quiet:
+        command.append("-q")
+    pipes = [os.pipe() for _ in keys]
+    try:
+        proc = subprocess.Popen(
+            command + ["/dev/fd/%d" % read_fd for read_fd, _ in pipes],
+            # Like `ssh-add -`, never read a passphrase from the terminal
+            stdin=subprocess.DEVNULL,
+            env=envdict,
+            pass_fds=[read_fd for read_fd, _ in pipes],
+        )
+    except BaseException:
+        for _, write_fd in pipes:
+            os.close(write_fd)
+        raise
+    finally:
+        for read_fd, _ in pipes:
+            os.close(read_fd)
+
+    # ssh-add reads the keys in order, so writing them in order can't deadlock
+    for ssh_key, (_, write_fd) in zip(keys, pipes):
+        try:
+            with open(write_fd, "wb") as pipe:
+                pipe.write(ssh_key)
+        except BrokenPipeError:
+            pass
+
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, command)
 
 
 if __name__ == "__main__":
@@ -302,6 +815,21 @@ if __name__ == "__main__":
             default="",
             help="session key of bitwarden",
         )
+        parser.add_argument(
+            "--cache-session",
+            action="store_true",
+            help="cache the bitwarden session in the OS keyring between runs",
+        )
+        parser.add_argument(
+            "--clear-session-cache",
+            action="store_true",
+            help="remove the bitwarden session cached in the OS keyring and exit",
+        )
+        parser.add_argument(
+            "--serve",
+            action="store_true",
+            help="query the vault through a temporary local `bw serve` API",
+        )
 
         return parser.parse_args()
 
@@ -321,29 +849,39 @@ if __name__ == "__main__":
 
         logging.basicConfig(format="%(levelname)-8s %(message)s", level=loglevel)
 
-        try:
-            logging.info("Getting Bitwarden session")
-            session = get_session(args.session)
-            logging.debug("Session = %s", session)
-
-            logging.info("Getting folder list")
-            folder_id = get_folders(session, args.foldername)
+        if (args.cache_session or args.clear_session_cache) and not HAS_KEYRING:
+            log.warning("Caching the Bitwarden session requires the keyring package")
 
-            logging.info("Getting folder items")
-            items = folder_items(session, folder_id)
+        if args.clear_session_cache:
+            if clear_cached_session():
+                log.info("Removed the cached Bitwarden session")
+            return
 
-            logging.info("Attempting to add keys to ssh-agent")
-            add_ssh_keys(session, items, args.customfield, args.passphrasefield, args.passphrase, args.legacymode, args.quiet)
+        try:
+            log.info("Getting Bitwarden session")
+            session = get_session(args.session, args.cache_session)
+            log.debug("Session = %s", session)
+
+            vault = BwServe(session) if args.serve else BwCli(session)
+            with vault:
+                log.info("Getting folder items")
+                items = folder_items(vault, args.foldername)
+
+                log.info("Attempting to add keys to ssh-agent")
+                add_ssh_keys(
+                    vault,
+                    items,
+                    args.customfield,
+                    args.passphrasefield,
+                    args.passphrase,
+                    args.legacymode,
+                    args.quiet,
+                )
         except RuntimeError as error:
-            logging.critical(str(error))
+            log.critical(str(error))
         except subprocess.CalledProcessError as error:
             if error.stderr:
-                logging.critical('"%s" error: %s', error.cmd[0], error.stderr)
-            logging.debug("Error running %s", error.cmd)
+                log.critical('"%s" error: %s', error.cmd[0], error.stderr)
+            log.debug("Error running %s", error.cmd)
 
-    if os.environ.get("SSH_ASKPASS") and os.environ.get(
-        "SSH_ASKPASS"
-    ) == os.path.realpath(__file__):
-        print(os.environ.get("SSH_KEY_PASSPHRASE"))
-    else:
-        main()
+    main()